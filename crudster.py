@@ -1,50 +1,177 @@
+# cython: language_level=3
 
 import argparse
+import asyncio
 from datetime import datetime, timedelta
+import functools
 import json
+import re
 import traceback
 from uuid import UUID, uuid4
 
-from bson import ObjectId
-from motor import motor_tornado
-from tornado import escape, gen, ioloop, web
+from bson import Binary, ObjectId
+from bson.binary import OLD_UUID_SUBTYPE, UUID_SUBTYPE
+from pymongo import AsyncMongoClient, WriteConcern
+from tornado import escape, httpserver, ioloop, netutil, process, web
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-class _JSONEncoder(json.JSONEncoder):
-    """Custom JSON encoder."""
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-    def default(self, obj):
-        if isinstance(obj, UUID):
-            return obj.hex
-        return json.JSONEncoder.default(self, obj)
+
+def _default(obj):
+    """Serialize objects the JSON encoder does not handle natively."""
+
+    if isinstance(obj, UUID):
+        return obj.hex
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+def _json_dumps(document):
+    """Encode document as UTF-8 JSON bytes
+
+    Uses orjson when available, falling back to the standard library (e.g.
+    under PyPy)."""
+
+    if orjson is not None:
+        return orjson.dumps(document, default=_default,
+                option=orjson.OPT_NON_STR_KEYS)
+    return escape.utf8(json.dumps(document, default=_default,
+            separators=(",", ":")))
+
+
+def _uuid_binaries(uuid):
+    """Stored forms of a raw document ID
+
+    New documents store IDs as subtype 4 binary UUIDs.  Documents written
+    before that hold legacy subtype 3 UUIDs with the same bytes, so match
+    both."""
+
+    return [Binary(uuid, UUID_SUBTYPE), Binary(uuid, OLD_UUID_SUBTYPE)]
+
+
+def _uuid_filter(uuid: str) -> dict:
+    """Query filter matching a document ID
+
+    The URL pattern guarantees 32 hex digits, so no UUID object is needed."""
+
+    return {"uuid": {"$in": _uuid_binaries(bytes.fromhex(uuid))}}
+
+
+def _json_loads(body):
+    """Decode JSON request body
+
+    Both decoders take the body as bytes, without decoding it to str first."""
+
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+class _FindOneBatcher:
+    """Coalesce concurrent single-document lookups
+
+    Lookups made within delay seconds of each other, up to max_size distinct
+    document IDs, are answered by one $in query instead of one find_one each.
+    """
+
+    def __init__(self, collection, delay=0.001, max_size=128):
+        self.collection = collection
+        self.delay = delay
+        self.max_size = max_size
+        self.pending = {}
+        self.timeout = None
+
+    def find_one(self, uuid):
+        """Future resolving to the document with raw ID uuid, or None"""
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(uuid, []).append(future)
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timeout is None:
+            self.timeout = ioloop.IOLoop.current().call_later(self.delay,
+                    self.flush)
+        return future
+
+    def flush(self):
+        """Query for all pending lookups now"""
+
+        if self.timeout is not None:
+            ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        pending, self.pending = self.pending, {}
+        ioloop.IOLoop.current().spawn_callback(self._resolve, pending)
+
+    async def _resolve(self, pending):
+        """Run one query and hand each waiting lookup its document"""
+
+        uuids = [binary for uuid in pending for binary in _uuid_binaries(uuid)]
+        try:
+            results = {bytes(result["uuid"]): result async for result in
+                    self.collection.find({"uuid": {"$in": uuids}},
+                        {"_id": False})}
+        except Exception as error:
+            for futures in pending.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+            return
+        for uuid, futures in pending.items():
+            result = results.get(uuid)
+            for future in futures:
+                if not future.done():
+                    future.set_result(result)
 
 
 class CRUDRequestHandler(web.RequestHandler):
     """Base CRUD API Interface"""
 
-    def initialize(self):
-        """Connect to document store"""
+    # Number of documents to buffer before flushing a listing to the client.
+
+    flush_interval = 100
+
+    def initialize(self, db, collection, batcher):
+        """Connect to document store
+
+        Resolved once by create_crudster and passed in through the URL spec,
+        so no settings lookups are needed per request."""
 
-        self.db = self.settings["db"]
-        self.collection = self.db[self.settings["collection_name"]]
-        self.index_args = self.settings.get("index_args", list())
+        self.db = db
+        self.collection = collection
+        self.batcher = batcher
+
+    def prepare(self):
+        """Reject document IDs that are not version 4 UUIDs
+
+        The URL pattern only checks for 32 hex digits."""
+
+        uuid = self.path_args[0] if self.path_args else None
+        if uuid and (uuid[12] != "4" or uuid[16] not in "89ab"):
+            raise web.HTTPError(404)
+
+    def set_default_headers(self):
+        """Every response is JSON unless a method says otherwise"""
+
+        self.set_header("Content-Type", "application/json; charset=UTF-8")
 
     def write_json(self, document):
         """Format output as JSON"""
 
-        self.set_header("Content-Type", "application/json; charset=UTF-8")
-        self.write(escape.utf8(json.dumps(document, cls=_JSONEncoder)))
+        self.write(_json_dumps(document))
 
-    def write_dict(self, *args, **kwargs):
-        """Format dictionary or parameter list as JSON dictionary"""
+    def write_json_kwargs(self, **kwargs):
+        """Format parameter list as JSON dictionary"""
 
-        if args:
-            if len(args) == 1 and type(args[0]) is dict:
-                self.write_json(args[0])
-            else:
-                raise ValueError
-        else:
-            self.write_json(kwargs)
+        self.write_json(kwargs)
 
     def write_error(self, status_code, **kwargs):
         """Format error as JSON dictionary"""
@@ -54,7 +181,8 @@ class CRUDRequestHandler(web.RequestHandler):
             for line in traceback.format_exception(*kwargs["exc_info"]):
                 self.write(line)
         else:
-            self.write_dict(status_code=status_code, reason=self._reason)
+            self.write_json_kwargs(status_code=status_code,
+                    reason=self._reason)
         self.finish()
 
     def decode_and_validate_document(self):
@@ -65,7 +193,7 @@ class CRUDRequestHandler(web.RequestHandler):
         validation but a hook is included to cover anything on top of that.
         """
 
-        document = escape.json_decode(self.request.body)
+        document = _json_loads(self.request.body)
         self.validate_document(document)
         return document
 
@@ -76,73 +204,72 @@ class CRUDRequestHandler(web.RequestHandler):
 
         pass
 
-    @gen.coroutine
-    def create_indices(self):
-        """Create indices
-
-        This runs during the first POST operation."""
-
-        for (args, kwargs) in self.index_args:
-            yield self.collection.create_index(*args, **kwargs)
-
-    @gen.coroutine
-    def post(self, uuid):
+    async def post(self, uuid):
         """Store new document"""
 
         # API determines document ID, not client.
 
         if uuid:
             raise web.HTTPError(400)
-        uuid = uuid4()
+        uuid = uuid4().bytes
 
         # Decode, validate, and insert document.
 
         document = self.decode_and_validate_document()
-        result = yield self.collection.insert_one(dict(document=document, 
-            uuid=uuid))
-
-        # Create any indices.
-
-        yield self.create_indices()
+        result = await self.collection.insert_one({"document": document,
+            "uuid": Binary(uuid, UUID_SUBTYPE)})
 
         # Return inserted document ID for client future reference.
 
-        self.write_dict(uuid=uuid)
+        self.write_json_kwargs(uuid=uuid.hex())
 
-    @gen.coroutine
-    def get(self, uuid):
+    async def get(self, uuid):
         """Retrieve stored documents"""
 
         if uuid:
-            yield self.get_one_document(uuid)
+            await self.get_one_document(uuid)
         else:
-            yield self.get_many_documents()
+            await self.get_many_documents()
 
-    @gen.coroutine
-    def get_one_document(self, uuid):
+    async def get_one_document(self, uuid: str):
         """Retrieve one document"""
 
-        result = yield self.collection.find_one({"uuid": UUID(uuid)})
+        result = await self.batcher.find_one(bytes.fromhex(uuid))
         if result:
-            self.write_dict(result["document"])
+            self.write_json(result["document"])
         else:
             raise web.HTTPError(404)
 
-    @gen.coroutine
-    def get_many_documents(self):
+    async def get_many_documents(self):
         """Retrieve a list of documents"""
-        # FIXME: skip, limit, sort, 
-        # http://motor.readthedocs.io/en/stable/tutorial-tornado.html#querying-for-more-than-one-document
-
-        cursor = self.collection.find()
-        documents = dict()
-        while (yield cursor.fetch_next):
-            result = cursor.next_object()
-            documents[result["uuid"].hex] = result["document"]
-        self.write_dict(documents)
-
-    @gen.coroutine
-    def put(self, uuid):
+        # FIXME: skip, limit, sort
+
+        # Stream the JSON dictionary out as documents arrive instead of
+        # building the whole thing in memory first.
+
+        separator = b"{"
+        count = 0
+        try:
+            async for result in self.collection.find({}, {"_id": False}):
+                self.write(b"".join((separator,
+                    _json_dumps(result["uuid"].hex()), b":",
+                    _json_dumps(result["document"]))))
+                separator = b","
+                count += 1
+                if count % self.flush_interval == 0:
+                    await self.flush()
+        except Exception:
+
+            # Once part of the listing is flushed an error status can no
+            # longer be sent, so drop the connection rather than let the
+            # client see a truncated 200 response.
+
+            if count >= self.flush_interval:
+                self.request.connection.close()
+            raise
+        self.write(b"{}" if count == 0 else b"}")
+
+    async def put(self, uuid):
         """Replace existing document"""
 
         # Document ID is required.
@@ -153,57 +280,128 @@ class CRUDRequestHandler(web.RequestHandler):
         # Decode, validate, and replace document.
 
         document = self.decode_and_validate_document()
-        result = yield self.collection.find_one_and_update(
-                {"uuid": UUID(uuid)}, 
-                {"$set": dict(document=document)})
+        result = await self.collection.update_one(_uuid_filter(uuid),
+                {"$set": {"document": document}})
 
-        # Return empty document if update succeed.
+        # Return empty document if update succeed.  Unacknowledged writes
+        # (w=0) report no match count, so assume success.
 
-        if result:
-            self.write_dict()
+        if not result.acknowledged or result.matched_count == 1:
+            self.write_json_kwargs()
         else:
             raise web.HTTPError(404)
 
-    @gen.coroutine
-    def delete(self, uuid):
+    async def delete(self, uuid):
         """Delete document"""
 
         # Find document by ID and remove it.
 
-        result = yield self.collection.delete_one({"uuid": UUID(uuid)})
+        result = await self.collection.delete_one(_uuid_filter(uuid))
 
-        # Return empty document if it succeeded.
+        # Return empty document if it succeeded.  Unacknowledged writes
+        # (w=0) report no delete count, so assume success.
 
-        if result.deleted_count == 1:
-            self.write_dict()
+        if not result.acknowledged or result.deleted_count == 1:
+            self.write_json_kwargs()
         else:
             raise web.HTTPError(404)
 
 
-def create_crudster(api_prefix="/", collection_name="data",
-        database_name="crudster", handler=CRUDRequestHandler,
-        initialize_database=False, mongodb_uri="mongodb://127.0.0.1:27017",
-        **kwargs):
+async def prepare_database(client, database_name, collection_name,
+        index_args, initialize_database=False):
+    """Clear database if requested and create indices
 
-    client = motor_tornado.MotorClient(mongodb_uri)
+    This runs once before the application starts serving rather than on the
+    request path."""
 
     if initialize_database:
-        client.drop_database(database_name)
+        await client.drop_database(database_name)
+    collection = client[database_name][collection_name]
+    for (args, kwargs) in index_args:
+        await collection.create_index(*args, **kwargs)
+
+
+def create_crudster(api_prefix="/", batch_delay=0.001, batch_size=128,
+        collection_name="data", database_name="crudster",
+        handler=CRUDRequestHandler, index_args=None, initialize_database=False,
+        max_idle_time_ms=None, max_pool_size=None, min_pool_size=None,
+        mongodb_uri="mongodb://127.0.0.1:27017", wait_queue_timeout_ms=None,
+        write_concern_journal=None, write_concern_w=None, **kwargs):
+    """Create the document store application
+
+    Await prepare_crudster() on the result before it starts serving;
+    clearing the database and creating indices happen there."""
+
+    # Keyword options override the URI, so only pass the ones given.
+
+    pool_options = {"maxIdleTimeMS": max_idle_time_ms,
+            "maxPoolSize": max_pool_size, "minPoolSize": min_pool_size,
+            "waitQueueTimeoutMS": wait_queue_timeout_ms}
+    client = AsyncMongoClient(mongodb_uri, **{key: value for key, value in
+            pool_options.items() if value is not None})
 
     db = client[database_name]
 
-    settings = dict(db=db, collection_name=collection_name)
+    # Document IDs are looked up on every request other than listing.
+
+    if index_args is None:
+        index_args = [(("uuid",), {"unique": True})]
+
+    # Deployments may trade write durability for latency.  Options given here
+    # override the URI's write concern rather than replace it.
+
+    write_concern = dict(client.write_concern.document)
+    if write_concern_w is not None:
+        write_concern["w"] = write_concern_w
+    if write_concern_journal is not None:
+        write_concern["j"] = write_concern_journal
+    collection = db.get_collection(collection_name,
+            write_concern=WriteConcern(**write_concern))
+
+    settings = {"db": db,
+            "prepare_database": functools.partial(prepare_database, client,
+                database_name, collection_name, index_args,
+                initialize_database)}
+
+    # Tornado only appends "$" to string patterns, so anchor it here.
+
+    pattern = re.compile(r"{}([0-9a-f]{{32}})?$".format(api_prefix), re.ASCII)
 
     return web.Application([
-        (r"{}([0-9a-f]{{12}}4[0-9a-f]{{3}}[89ab][0-9a-f]{{15}})?".format(api_prefix), handler),
+        (pattern, handler, {"db": db, "collection": collection,
+            "batcher": _FindOneBatcher(collection, batch_delay, batch_size)}),
     ], **settings)
 
 
+async def prepare_crudster(crud):
+    """Prepare the database for an application from create_crudster
+
+    Clears the database if initialize_database was given and creates the
+    configured indices.  Await this before the application serves requests.
+    """
+
+    await crud.settings["prepare_database"]()
+
+
+def _write_concern_w(value):
+    """Parse write concern w as a node count or a tag like majority"""
+
+    return int(value) if value.isdigit() else value
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--api-prefix", "-a",
             default="/",
             help="application API prefix")
+    parser.add_argument("--batch-delay",
+            default=0.001,
+            help="seconds to wait for concurrent reads to batch together",
+            type=float)
+    parser.add_argument("--batch-size",
+            default=128,
+            help="maximum documents fetched by one batched read",
+            type=int)
     parser.add_argument("--collection-name", "-c",
             default="data",
             help="MongoDB collection name for document store")
@@ -213,20 +411,88 @@ def parse_arguments():
     parser.add_argument("--initialize-database", "-i",
             action="store_true",
             help="whether to initialize/clear database at startup")
+    parser.add_argument("--max-idle-time-ms",
+            default=None,
+            help="milliseconds a pooled MongoDB connection may sit idle, "
+                "overrides the URI",
+            type=int)
+    parser.add_argument("--max-pool-size",
+            default=None,
+            help="maximum MongoDB connections per process, overrides the URI",
+            type=int)
+    parser.add_argument("--min-pool-size",
+            default=None,
+            help="MongoDB connections kept open per process, overrides the "
+                "URI",
+            type=int)
     parser.add_argument("--mongodb-uri", "-m",
             default="mongodb://127.0.0.1:27017",
             help="MongoDB server URI")
+    parser.add_argument("--num-processes", "-n",
+            default=0,
+            help="number of server processes, 0 for one per CPU",
+            type=int)
     parser.add_argument("--port", "-p",
             default=8888,
             help="port for API to listen on",
             type=int)
+    parser.add_argument("--wait-queue-timeout-ms",
+            default=None,
+            help="milliseconds to wait for a free MongoDB connection, "
+                "overrides the URI",
+            type=int)
+    parser.add_argument("--write-concern-journal",
+            action=argparse.BooleanOptionalAction,
+            default=None,
+            help="whether writes wait for the MongoDB journal, overrides "
+                "the URI")
+    parser.add_argument("--write-concern-w",
+            default=None,
+            help="MongoDB write concern w, e.g. 0, 1 or majority, overrides "
+                "the URI",
+            type=_write_concern_w)
     return parser.parse_args()
 
 
+async def drop_database(mongodb_uri, database_name):
+    """Drop database with a short-lived client"""
+
+    client = AsyncMongoClient(mongodb_uri)
+    try:
+        await client.drop_database(database_name)
+    finally:
+        await client.close()
+
+
 def main():
     args = parse_arguments()
-    crud = create_crudster(**vars(args))
-    crud.listen(args.port)
+
+    # Run on uvloop when available.  No event loop exists until after the
+    # fork, so each server process gets its own.
+
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    # Bind and clear the database in the parent, then fork.  Each child
+    # creates its own client since connection pools cannot be shared across
+    # processes.
+
+    sockets = netutil.bind_sockets(args.port)
+    if args.initialize_database:
+        asyncio.run(drop_database(args.mongodb_uri, args.database_name))
+    process.fork_processes(args.num_processes)
+
+    crud = create_crudster(**{**vars(args), "initialize_database": False})
+
+    # Connect and create indices before accepting requests, so the first
+    # ones do not pay for it and never run without the indices.
+
+    db = crud.settings["db"]
+    ioloop.IOLoop.current().run_sync(lambda: db.command("ping"))
+    ioloop.IOLoop.current().run_sync(lambda: prepare_crudster(crud))
+
+    server = httpserver.HTTPServer(crud)
+    server.add_sockets(sockets)
     ioloop.IOLoop.current().start()
 
 
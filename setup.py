@@ -1,12 +1,24 @@
 from distutils.core import setup
 
+# Compile the module with Cython when it is available; the pure Python module
+# is installed either way and is what PyPy uses.
+
+try:
+    from Cython.Build import cythonize
+except ImportError:
+    ext_modules = []
+else:
+    ext_modules = cythonize(["crudster.py"],
+            compiler_directives={"language_level": "3", "boundscheck": False})
+
 setup(
         name="crudster",
         version="0.0.1",
-        description="Simple Motor-based document-store REST API",
+        description="Simple MongoDB document-store REST API",
         author="R. C. Thomas",
         author_email="rcthomas@lbl.gov",
         url="https://github.com/rcthomas/crudster",
-        requires=["pymongo (>=3.6.0)", "tornado (>=4.5.3)", "motor (>=1.2.0)"],
+        requires=["pymongo (>=4.10.0)", "tornado (>=6.0)"],
         py_modules=["crudster"],
+        ext_modules=ext_modules,
 )
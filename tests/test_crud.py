@@ -3,14 +3,17 @@ import sys
 from urllib.parse import urljoin
 
 import pytest
+from tornado import gen
 from tornado.escape import json_encode, json_decode
 from tornado.httpclient import HTTPError
 
-from crudster import create_crudster
+from crudster import CRUDRequestHandler, create_crudster, prepare_crudster
 
 @pytest.fixture
-def app():
-    crud = create_crudster(initialize_database=True)
+def app(io_loop, request):
+    crud = create_crudster(initialize_database=True,
+            **getattr(request, "param", dict()))
+    io_loop.run_sync(lambda: prepare_crudster(crud))
     crud.listen(8888)
     return crud
 
@@ -18,6 +21,18 @@ def app():
 def base_url():
     return "http://localhost:8888"
 
+def _collection(crud):
+    return crud.wildcard_router.rules[0].target_kwargs["collection"]
+
+@gen.coroutine
+def _poll(http_client, url, check):
+    for attempt in range(50):
+        response = yield http_client.fetch(url, raise_error=False)
+        if check(response):
+            return response
+        yield gen.sleep(0.1)
+    pytest.fail("{} never passed check".format(url))
+
 @pytest.mark.gen_test
 def test_get(http_client, base_url):
     response = yield http_client.fetch(base_url)
@@ -26,6 +41,15 @@ def test_get(http_client, base_url):
     response_doc = json_decode(response.body)
     assert len(response_doc) == 0
 
+@pytest.mark.gen_test
+def test_uuid_index(app):
+
+    # Preparation creates a unique index on document ID
+
+    indices = yield app.settings["db"]["data"].index_information()
+    assert any(index["key"] == [("uuid", 1)] and index.get("unique")
+            for index in indices.values())
+
 @pytest.mark.gen_test
 def test_crud(http_client, base_url):
 
@@ -77,3 +101,104 @@ def test_crud(http_client, base_url):
     with pytest.raises(HTTPError) as exc:
         r_response = yield http_client.fetch(urljoin(base_url, c_response_doc["uuid"]))
     assert exc.value.code == 404
+
+@pytest.mark.gen_test
+def test_get_many(http_client, base_url, monkeypatch):
+
+    # Flush partway through the listing so it goes out in several chunks
+
+    monkeypatch.setattr(CRUDRequestHandler, "flush_interval", 2)
+
+    docs = [dict(Number=number) for number in range(5)]
+
+    # Create several documents, remembering their UUIDs
+
+    uuids = dict()
+    for doc in docs:
+        c_response = yield http_client.fetch(base_url, method="POST", body=json_encode(doc))
+        uuids[json_decode(c_response.body)["uuid"]] = doc
+
+    # Read all, should get every document back keyed by UUID
+
+    r_response = yield http_client.fetch(base_url)
+    assert r_response.code == 200
+
+    r_response_doc = json_decode(r_response.body)
+    assert r_response_doc == uuids
+
+@pytest.mark.gen_test
+def test_get_not_uuid4(http_client, base_url):
+
+    # Well-formed hex but not a version 4 UUID, should be not found
+
+    with pytest.raises(HTTPError) as exc:
+        yield http_client.fetch(urljoin(base_url, "0" * 32))
+    assert exc.value.code == 404
+
+@pytest.mark.gen_test
+def test_get_concurrent(http_client, base_url):
+
+    docs = [dict(Number=number) for number in range(5)]
+
+    # Create several documents
+
+    c_responses = yield [http_client.fetch(base_url, method="POST", body=json_encode(doc)) for doc in docs]
+    uuids = [json_decode(c_response.body)["uuid"] for c_response in c_responses]
+
+    # Read them all at once, including one twice, should each get their own document back
+
+    r_responses = yield [http_client.fetch(urljoin(base_url, uuid)) for uuid in uuids + uuids[:1]]
+    for r_response, doc in zip(r_responses, docs + docs[:1]):
+        assert r_response.code == 200
+        assert json_decode(r_response.body) == doc
+
+def test_pool_options_from_uri():
+
+    # Pool options in the URI apply unless overridden
+
+    crud = create_crudster(mongodb_uri="mongodb://127.0.0.1:27017/?maxPoolSize=7")
+    assert crud.settings["db"].client.options.pool_options.max_pool_size == 7
+
+    crud = create_crudster(mongodb_uri="mongodb://127.0.0.1:27017/?maxPoolSize=7", max_pool_size=3)
+    assert crud.settings["db"].client.options.pool_options.max_pool_size == 3
+
+def test_write_concern_from_uri():
+
+    # Write concern in the URI applies unless overridden
+
+    uri = "mongodb://127.0.0.1:27017/?w=majority&journal=true"
+
+    collection = _collection(create_crudster(mongodb_uri=uri))
+    assert collection.write_concern.document == {"w": "majority", "j": True}
+
+    collection = _collection(create_crudster(mongodb_uri=uri, write_concern_w=1))
+    assert collection.write_concern.document == {"w": 1, "j": True}
+
+@pytest.mark.parametrize("app", [dict(write_concern_w=0)], indirect=True)
+@pytest.mark.gen_test
+def test_crud_unacknowledged(http_client, base_url):
+
+    doc = dict(Hello="Doctor")
+    new_doc = dict(Goodbye="Doctor")
+
+    # Create, should get a UUID back and the document should show up
+
+    c_response = yield http_client.fetch(base_url, method="POST", body=json_encode(doc))
+    assert c_response.code == 200
+    url = urljoin(base_url, json_decode(c_response.body)["uuid"])
+
+    yield _poll(http_client, url, lambda r: r.code == 200)
+
+    # Update, the new document should show up
+
+    u_response = yield http_client.fetch(url, method="PUT", body=json_encode(new_doc))
+    assert u_response.code == 200
+
+    yield _poll(http_client, url, lambda r: r.code == 200 and json_decode(r.body) == new_doc)
+
+    # Delete, the document should go away
+
+    d_response = yield http_client.fetch(url, method="DELETE")
+    assert d_response.code == 200
+
+    yield _poll(http_client, url, lambda r: r.code == 404)